@@ -7,6 +7,7 @@ Güncel bot.py
 - Log rotasyonu (log.txt -> log.txt.1 ...)
 - Telegram bildirimleri (tablo formatında)
 - Stop-loss bildirimi (tablo) ve pozisyon kapatma
+- Kesişim kontrolü kapanmış 4H mumlarla (15 dakikada bir), TP/SL kontrolü dakikalık fiyatla
 - Basit telegram spam koruması (aynı mesajı kısa süre tekrar göndermez)
 
 Kullanım:
@@ -18,15 +19,32 @@ Not: Bu sürüm yfinance kullanıyor; ağ/indirme hatalarında retry yapar.
 
 import os
 import time
+import atexit
+import signal
 import json
 import math
+import hashlib
 import threading
+import queue
+import logging
+import sys
+from logging.handlers import RotatingFileHandler
 from datetime import datetime, timezone
+from functools import lru_cache
+import numpy as np
 import pandas as pd
+from numba import njit, prange
 import yfinance as yf
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # orjson yoksa stdlib json ile devam
+    orjson = None
+
 # --- Ortam Değişkenleri Yükle ---
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -84,19 +102,61 @@ LOG_FILE = os.path.join(BASE_DIR, "log.txt")
 # --- Log Rotasyon Ayarları ---
 MAX_LOG_SIZE = 100 * 1024 * 1024  # 100 MB
 BACKUP_COUNT = 50  # fazla eski log saklama sayısı
-log_lock = threading.Lock()
+
+logger = logging.getLogger("bot")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_formatter = logging.Formatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+_file_handler = RotatingFileHandler(LOG_FILE, maxBytes=MAX_LOG_SIZE, backupCount=BACKUP_COUNT, encoding="utf-8")
+_file_handler.setFormatter(_log_formatter)
+logger.addHandler(_file_handler)
+_console_handler = logging.StreamHandler(sys.stdout)
+_console_handler.setFormatter(_log_formatter)
+logger.addHandler(_console_handler)
 
 # --- Telegram spam kontrol ---
 # Aynı mesajı tekrar yollamamak için state içinde symbol->last_msg ve global->last_msg
 MIN_TELEGRAM_INTERVAL = 60  # aynı mesajı en az 60s aralıkla gönder
 
+# --- State eşzamanlılık ---
+# Telegram worker thread'i (mark_sent) state'i paylaştığı için tüm değişiklikler bu kilit altında
+state_lock = threading.Lock()
+
+# --- State disk yazımı ---
+# State bellekte tutulur; diske en fazla STATE_FLUSH_INTERVAL saniyede bir (değiştiyse) yazılır
+STATE_FLUSH_INTERVAL = 5
+_state_dirty = False
+_last_flush = 0.0
+
+# --- Telegram bağlantı havuzu ---
+# Her mesajda yeni TCP+TLS bağlantısı kurmamak için keep-alive oturumu
+TELEGRAM_TIMEOUT = 10
+TG_SESSION = requests.Session()
+TG_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                         max_retries=Retry(total=3, backoff_factor=0.5)))
+TG_QUEUE = queue.Queue(maxsize=1000)  # (msg, state, symbol); _tg_worker tarafından tüketilir
+TG_DRAIN_TIMEOUT = 15  # kapanışta kuyruktaki mesajlar için en fazla bekleme (s)
+
+# --- Toplu indirme ---
+BULK_CHUNK_SIZE = 20  # Yahoo tek istekte ~20 sembolü sorunsuz işliyor
+BAR_SECONDS = {"4h": 4 * 60 * 60, "1d": 24 * 60 * 60}  # mum süreleri (canlı mum tespiti)
+# Önbellek tazeleme süresi: günlük mumlar borsaya göre farklı saatlerde (UTC 00:00, 21:00, 04:00...) kapanır;
+# saatlik tazeleme yeni kapanan mumu en geç bir saat içinde yakalar
+DOWNLOAD_CACHE_SECONDS = {"1d": 60 * 60}
+
+# --- Kontrol zamanlaması ---
+CROSSOVER_CHECK_INTERVAL = 15 * 60  # kapanmış 4H mumlarda kesişim kontrolü aralığı (s)
+STOP_CHECK_INTERVAL = 60            # TP/SL fiyat kontrolü aralığı (s)
+_daily_emas = {}                  # symbol -> (günlük EMA100, EMA200); stop-loss mesajları için
+
 # ----------------- Yardımcı Fonksiyonlar -----------------
 
-def safe_download(symbol, interval, period, retries=3, pause=2, auto_adjust=True):
+def safe_download(symbol, interval, period, retries=3, pause=2, auto_adjust=True, **kwargs):
     """yfinance indirme işlemini retries ile sarar. Boş df veya exception durumunda tekrar dener."""
     for attempt in range(1, retries + 1):
         try:
-            df = yf.download(symbol, interval=interval, period=period, progress=False, auto_adjust=auto_adjust)
+            df = yf.download(symbol, interval=interval, period=period, progress=False, auto_adjust=auto_adjust,
+                             actions=False, **kwargs)
             if not df.empty:
                 return df
         except Exception as e:
@@ -105,60 +165,103 @@ def safe_download(symbol, interval, period, retries=3, pause=2, auto_adjust=True
     return pd.DataFrame()
 
 
-def rotate_logs():
-    """Log dosyası MAX_LOG_SIZE'ı aşınca döndürme işlemi yapar."""
-    try:
-        if not os.path.exists(LOG_FILE):
-            return
-
-        if os.path.getsize(LOG_FILE) >= MAX_LOG_SIZE:
-            # eski logları kaydır
-            for i in range(BACKUP_COUNT - 1, 0, -1):
-                src = f"{LOG_FILE}.{i}"
-                dst = f"{LOG_FILE}.{i+1}"
-                if os.path.exists(src):
-                    os.replace(src, dst)
-            # Mevcut log.txt -> log.txt.1
-            os.replace(LOG_FILE, f"{LOG_FILE}.1")
-    except Exception as e:
-        print(f"Log rotasyon hatası: {e}")
+def bulk_download(symbols, interval, period, retries=3, pause=2, closed_only=False):
+    """Sembolleri BULK_CHUNK_SIZE'lık gruplar halinde tek istekte indirir.
+    symbol -> kapanış fiyatları (float64 numpy dizisi) sözlüğü döner; indirilemeyen semboller boş dizi alır.
+    closed_only=True ise henüz kapanmamış (canlı) mumlar atılır: başlangıcı + mum süresi şimdiden sonra olan satırlar.
+    Hisse mumları seans açılışına hizalı olduğundan kapanış UTC ızgarasıyla değil mumun kendi başlangıcıyla hesaplanır.
+    """
+    result = {}
+    for i in range(0, len(symbols), BULK_CHUNK_SIZE):
+        chunk = symbols[i:i + BULK_CHUNK_SIZE]
+        df = safe_download(" ".join(chunk), interval, period, retries=retries, pause=pause,
+                           group_by="ticker", threads=True)
+        if closed_only and not df.empty:
+            starts = df.index if df.index.tz is not None else df.index.tz_localize("UTC")
+            df = df[starts + pd.Timedelta(seconds=BAR_SECONDS[interval]) <= pd.Timestamp.now(tz="UTC")]
+        # Yalnızca Close kullanılıyor; diğer OHLCV sütunları hemen bırakılır
+        closes = df.xs("Close", axis=1, level=1).astype("float64", copy=False) if not df.empty else pd.DataFrame()
+        for sym in chunk:
+            if sym in closes.columns:
+                result[sym] = closes[sym].dropna().to_numpy()
+            else:
+                result[sym] = np.empty(0, dtype=np.float64)
+    return result
 
 
-def write_log(msg: str, symbol: str = None):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    line = f"[{now}] [{symbol}] {msg}" if symbol else f"[{now}] {msg}"
-    print(line)
+class _IncompleteDownload(Exception):
+    """Bazı semboller için veri gelmeyen indirme; sonuç önbelleğe alınmadan çağırana iletilir."""
 
-    try:
-        os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(line + "\n")
-    except Exception as e:
-        print(f"[ERROR] Log yazılamadı: {e}")
+    def __init__(self, closes):
+        super().__init__("eksik indirme")
+        self.closes = closes
+
+
+# cache_epoch yalnızca artar; eski dönemlere ait girdiler bir daha kullanılmaz, küçük maxsize yeterli
+@lru_cache(maxsize=4)
+def _cached_download(symbols, interval, period, cache_epoch):
+    """Kapanmış mumlardan oluşan bulk_download sonucunu aynı dönem (cache_epoch) süresince önbellekler."""
+    closes = bulk_download(list(symbols), interval, period, closed_only=True)
+    if not all(len(close) for close in closes.values()):
+        # Eksik/başarısız indirme önbelleğe alınmasın; bir sonraki çağrıda tekrar denensin
+        raise _IncompleteDownload(closes)
+    return closes
 
+
+def cached_download(symbols, interval, period):
+    """Yalnızca kapanmış mumları döner; aynı (semboller, interval, period) için
+    DOWNLOAD_CACHE_SECONDS süresince tekrar indirme yapmaz.
+    Yalnızca tüm semboller için veri gelen sonuçlar önbelleğe alınır.
+    Dönen diziler önbellekle paylaşılır, değiştirilmemelidir.
+    """
+    cache_epoch = int(time.time() // DOWNLOAD_CACHE_SECONDS[interval])
     try:
-        send_telegram(line)
-    except Exception as e:
-        print(f"[ERROR] Telegram gönderilemedi: {e}")
+        return _cached_download(tuple(symbols), interval, period, cache_epoch)
+    except _IncompleteDownload as e:
+        return e.closes
+
+
+def write_log(msg: str, symbol: str = None, level: str = "INFO", notify: bool = True):
+    """Log satırını dosyaya/konsola yazar; notify=True ise Telegram'a da gönderir."""
+    line = f"[{symbol}] {msg}" if symbol else msg
+    logger.log(getattr(logging, level, logging.INFO), line)
+
+    if notify:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            send_telegram(f"[{now}] {line}")
+        except Exception as e:
+            logger.error(f"[ERROR] Telegram gönderilemedi: {e}")
+
+
+def _loaded_last_msg(last):
+    """Diskten okunan last_msg kaydını hazırlar.
+    Eski sürümlerin tam metin kayıtları (text) atılır; mts önceki çalışmanın monotonic saatine ait olduğundan sıfırlanır.
+    """
+    if not isinstance(last, dict) or "hash" not in last:
+        return None
+    return {**last, "mts": None}
 
 
 def load_state():
     # Varsayılan state şeması
-    default = {symbol: {"in_position": False, "entry_price": None, "take_profit": TAKE_PROFIT, "last_msg": None} for symbol in ASSETS}
+    # ema_above: son kontrolde kapanmış 4H mumda EMA_SHORT > EMA_LONG mıydı (None: henüz bilinmiyor)
+    # daily_above: son kontrolde kapanmış günlük mumda EMA100 > EMA200 müydü (None: henüz bilinmiyor)
+    default = {symbol: {"in_position": False, "entry_price": None, "take_profit": TAKE_PROFIT, "last_msg": None,
+                        "ema_above": None, "daily_above": None} for symbol in ASSETS}
     if os.path.exists(STATE_FILE):
         try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                s = json.load(f)
-            # eksik alanları tamamla
+            if orjson is not None:
+                with open(STATE_FILE, "rb") as f:
+                    s = orjson.loads(f.read())
+            else:
+                with open(STATE_FILE, "r", encoding="utf-8") as f:
+                    s = json.load(f)
+            # eksik alanları tamamla (kayıtlı değerler varsayılanların üzerine yazılır)
             for k, v in default.items():
-                if k not in s:
-                    s[k] = v
-                else:
-                    for field in v:
-                        if field not in s[k]:
-                            s[k][field] = v[field]
-            if "global_last_msg" not in s:
-                s["global_last_msg"] = None
+                s[k] = {**v, **s.get(k, {})}
+                s[k]["last_msg"] = _loaded_last_msg(s[k]["last_msg"])
+            s["global_last_msg"] = _loaded_last_msg(s.get("global_last_msg"))
             return s
         except Exception as e:
             write_log(f"State yüklenirken hata, varsayılan state oluşturuluyor: {e}", level="ERROR")
@@ -167,96 +270,205 @@ def load_state():
 
 
 def save_state(state):
+    global _state_dirty, _last_flush
     tmp_file = STATE_FILE + ".tmp"
     try:
-        with open(tmp_file, "w", encoding="utf-8") as f:
-            json.dump(state, f, indent=4, ensure_ascii=False)
+        if orjson is not None:
+            with open(tmp_file, "wb") as f:
+                f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        else:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(state, f, indent=4, ensure_ascii=False)
         os.replace(tmp_file, STATE_FILE)
+        _state_dirty = False
+        _last_flush = time.time()
     except Exception as e:
         write_log(f"State kaydedilemedi: {e}", level="ERROR")
 
 
-def get_ema(df, period):
-    return df["Close"].ewm(span=period, adjust=False).mean()
+def mark_state_dirty():
+    """State'in diske yazılması gerektiğini işaretler (yazım maybe_flush_state ile yapılır)."""
+    global _state_dirty
+    _state_dirty = True
+
+
+def maybe_flush_state(state, min_interval=STATE_FLUSH_INTERVAL):
+    """State değiştiyse ve son yazımdan bu yana min_interval geçtiyse diske yazar."""
+    if _state_dirty and time.time() - _last_flush >= min_interval:
+        save_state(state)
+
+
+def _exit_on_sigterm(signum, frame):
+    """systemd SIGTERM ile durdurur; varsayılan davranış atexit kancalarını atladığı için SystemExit'e çevrilir."""
+    sys.exit(0)
+
+
+@njit(cache=True, fastmath=True)
+def ema_cross_kernel(close, span_s, span_l):
+    """Kısa ve uzun EMA'yı (adjust=False) tek geçişte hesaplar.
+    (kısa_önceki, kısa_son, uzun_önceki, uzun_son) döner.
+    """
+    n = close.shape[0]
+    alpha_s = 2.0 / (span_s + 1)
+    alpha_l = 2.0 / (span_l + 1)
+    es = close[0]
+    el = close[0]
+    es_p = es
+    el_p = el
+    for i in range(1, n):
+        es = alpha_s * close[i] + (1 - alpha_s) * es
+        el = alpha_l * close[i] + (1 - alpha_l) * el
+        if i == n - 2:
+            es_p = es
+            el_p = el
+    return es_p, es, el_p, el
+
+
+@njit(cache=True, parallel=True)
+def ema_matrix(close_mat, span_s, span_l):
+    """(T, N) kapanış matrisinin her sütunu için ema_cross_kernel'i paralel çalıştırır.
+    Sütunlar sağa hizalıdır; baştaki NaN dolgu atlanır. (4, N) çıktı döner.
+    """
+    T, N = close_mat.shape
+    out = np.empty((4, N))
+    for j in prange(N):
+        start = 0
+        while start < T and np.isnan(close_mat[start, j]):
+            start += 1
+        es_p, es, el_p, el = ema_cross_kernel(close_mat[start:, j], span_s, span_l)
+        out[0, j] = es_p
+        out[1, j] = es
+        out[2, j] = el_p
+        out[3, j] = el
+    return out
+
+
+def ema_pairs(closes, symbols, span_s, span_l, min_len):
+    """En az min_len kapanışı olan semboller için EMA'ları tek matris geçişinde hesaplar.
+    symbol -> [kısa_önceki, kısa_son, uzun_önceki, uzun_son] döner; verisi yetersiz semboller dahil edilmez.
+    """
+    valid = [sym for sym in symbols if len(closes[sym]) >= min_len]
+    if not valid:
+        return {}
+    T = max(len(closes[sym]) for sym in valid)
+    close_mat = np.full((T, len(valid)), np.nan)
+    for j, sym in enumerate(valid):
+        close_mat[T - len(closes[sym]):, j] = closes[sym]
+    return dict(zip(valid, ema_matrix(close_mat, span_s, span_l).T.tolist()))
+
+
+# JIT derleme maliyetini ilk sinyal kontrolünde değil, açılışta öde
+ema_matrix(np.zeros((3, 1), dtype=np.float64), EMA_SHORT, EMA_LONG)
 
 
 # ----------------- Mesaj Formatlama -----------------
 
-def format_signal_log(symbol, price, daily_ema100, daily_ema200, entry_price=None, tp=None):
-    take_profit_pct = tp if tp is not None else TAKE_PROFIT
-    stop_loss_price = (entry_price if entry_price else price) * (1 - STOP_LOSS / 100)
-    potential_profit_price = (entry_price if entry_price else price) * (1 + take_profit_pct / 100)
+SL_MULT = 1 - STOP_LOSS / 100
+TP_MULT = 1 + TAKE_PROFIT / 100
+
+_REL_PRICE = {True: "ÜSTÜNDE ✅", False: "ALTINDA ❌"}
+_EMA_RELATION = {True: "EMA100 > EMA200 (YUKARIDA ✅)", False: "EMA100 < EMA200 (AŞAĞIDA ❌)"}
+_UPGRADED_INFO = {
+    True: f"Günlük EMA100, EMA200'ü ÜSTÜNDE ✅ | Yeni TP %{UPGRADED_TP}",
+    False: "Günlük EMA100 henüz EMA200'ü yukarı kesmedi ❌",
+}
+
+# Sabit kısımlar bir kez formatlanır; {{...}} alanları mesaj başına .format() ile doldurulur
+_SIGNAL_TPL = (
+    f"\n📊 {{symbol}} ALIM SİNYALİ\n"
+    f"4H EMA{EMA_SHORT} & EMA{EMA_LONG} Kesişimi Yukarı!\n\n"
+    f"+-------------------+----------------+----------------------+\n"
+    f"|   Gösterge        |   Değer        |   Durum              |\n"
+    f"+-------------------+----------------+----------------------+\n"
+    f"| Günlük EMA100     | {{daily_ema100:,.2f}} | Fiyat {{rel_ema100:<12}} |\n"
+    f"| Günlük EMA200     | {{daily_ema200:,.2f}} | Fiyat {{rel_ema200:<12}} |\n"
+    f"| Alış Fiyatı       | {{price:,.2f}}   |                    |\n"
+    f"| Stop-Loss Seviyesi| {{stop_loss_price:,.2f}} | -%{STOP_LOSS:<15} |\n"
+    f"| Take-Profit Hedef | {{potential_profit_price:,.2f}} | +%{{profit_pct:<14}} |\n"
+    f"+-------------------+----------------+----------------------+\n"
+    f"Trend Durumu: {{ema_relation}}\n"
+    f"{{upgraded_info}}\n"
+)
+
+_STOPLOSS_TPL = (
+    f"\n⚠️ {{symbol}} STOP-LOSS TETİKLENDİ!\n\n"
+    f"+-------------------+----------------+----------------------+\n"
+    f"|   Gösterge        |   Değer        |   Durum              |\n"
+    f"+-------------------+----------------+----------------------+\n"
+    f"| Giriş Fiyatı      | {{entry:,.2f}}   |                      |\n"
+    f"| Güncel Fiyat      | {{price:,.2f}}   |                      |\n"
+    f"| Stop-Loss Seviyesi| {{stop_loss_price:,.2f}} | -%{STOP_LOSS:<15} |\n"
+    f"| Günlük EMA100     | {{daily_ema100:,.2f}} | Fiyat {{rel_ema100:<12}} |\n"
+    f"| Günlük EMA200     | {{daily_ema200:,.2f}} | Fiyat {{rel_ema200:<12}} |\n"
+    f"+-------------------+----------------+----------------------+\n"
+    f"Trend Durumu: {{ema_relation}}\n"
+    f"Gerçekleşen Kayıp: %{{loss_pct:.2f}}\n"
+)
 
-    rel_ema100 = "ÜSTÜNDE ✅" if price > daily_ema100 else "ALTINDA ❌"
-    rel_ema200 = "ÜSTÜNDE ✅" if price > daily_ema200 else "ALTINDA ❌"
-    ema_relation = "EMA100 > EMA200 (YUKARIDA ✅)" if daily_ema100 > daily_ema200 else "EMA100 < EMA200 (AŞAĞIDA ❌)"
 
-    upgraded_info = f"Günlük EMA100, EMA200'ü ÜSTÜNDE ✅ | Yeni TP %{UPGRADED_TP}" if daily_ema100 > daily_ema200 else "Günlük EMA100 henüz EMA200'ü yukarı kesmedi ❌"
+def format_signal_log(symbol, price, daily_ema100, daily_ema200, entry_price=None, tp=None):
+    take_profit_pct = tp if tp is not None else TAKE_PROFIT
+    tp_mult = TP_MULT if take_profit_pct == TAKE_PROFIT else 1 + take_profit_pct / 100
 
     # Kar potansiyeli yüzdesi (entry bazlı)
     base = entry_price if entry_price else price
-    profit_pct = take_profit_pct
-
-    table = (
-        f"\n📊 {symbol} ALIM SİNYALİ\n"
-        f"4H EMA{EMA_SHORT} & EMA{EMA_LONG} Kesişimi Yukarı!\n\n"
-        f"+-------------------+----------------+----------------------+\n"
-        f"|   Gösterge        |   Değer        |   Durum              |\n"
-        f"+-------------------+----------------+----------------------+\n"
-        f"| Günlük EMA100     | {daily_ema100:,.2f} | Fiyat {rel_ema100:<12} |\n"
-        f"| Günlük EMA200     | {daily_ema200:,.2f} | Fiyat {rel_ema200:<12} |\n"
-        f"| Alış Fiyatı       | {price:,.2f}   |                    |\n"
-        f"| Stop-Loss Seviyesi| {stop_loss_price:,.2f} | -%{STOP_LOSS:<15} |\n"
-        f"| Take-Profit Hedef | {potential_profit_price:,.2f} | +%{profit_pct:<14} |\n"
-        f"+-------------------+----------------+----------------------+\n"
-        f"Trend Durumu: {ema_relation}\n"
-        f"{upgraded_info}\n"
+    trend_up = daily_ema100 > daily_ema200
+
+    return _SIGNAL_TPL.format(
+        symbol=symbol,
+        price=price,
+        daily_ema100=daily_ema100,
+        daily_ema200=daily_ema200,
+        rel_ema100=_REL_PRICE[price > daily_ema100],
+        rel_ema200=_REL_PRICE[price > daily_ema200],
+        stop_loss_price=base * SL_MULT,
+        potential_profit_price=base * tp_mult,
+        profit_pct=take_profit_pct,
+        ema_relation=_EMA_RELATION[trend_up],
+        upgraded_info=_UPGRADED_INFO[trend_up],
     )
-    return table
 
 
 def format_stoploss_log(symbol, price, entry, daily_ema100, daily_ema200):
-    rel_ema100 = "ÜSTÜNDE ✅" if price > daily_ema100 else "ALTINDA ❌"
-    rel_ema200 = "ÜSTÜNDE ✅" if price > daily_ema200 else "ALTINDA ❌"
-    ema_relation = "EMA100 > EMA200 (YUKARIDA ✅)" if daily_ema100 > daily_ema200 else "EMA100 < EMA200 (AŞAĞIDA ❌)"
-
-    stop_loss_price = entry * (1 - STOP_LOSS / 100)
-    loss_pct = ((price - entry) / entry) * 100
-
-    table = (
-        f"\n⚠️ {symbol} STOP-LOSS TETİKLENDİ!\n\n"
-        f"+-------------------+----------------+----------------------+\n"
-        f"|   Gösterge        |   Değer        |   Durum              |\n"
-        f"+-------------------+----------------+----------------------+\n"
-        f"| Giriş Fiyatı      | {entry:,.2f}   |                      |\n"
-        f"| Güncel Fiyat      | {price:,.2f}   |                      |\n"
-        f"| Stop-Loss Seviyesi| {stop_loss_price:,.2f} | -%{STOP_LOSS:<15} |\n"
-        f"| Günlük EMA100     | {daily_ema100:,.2f} | Fiyat {rel_ema100:<12} |\n"
-        f"| Günlük EMA200     | {daily_ema200:,.2f} | Fiyat {rel_ema200:<12} |\n"
-        f"+-------------------+----------------+----------------------+\n"
-        f"Trend Durumu: {ema_relation}\n"
-        f"Gerçekleşen Kayıp: %{loss_pct:.2f}\n"
+    return _STOPLOSS_TPL.format(
+        symbol=symbol,
+        entry=entry,
+        price=price,
+        daily_ema100=daily_ema100,
+        daily_ema200=daily_ema200,
+        rel_ema100=_REL_PRICE[price > daily_ema100],
+        rel_ema200=_REL_PRICE[price > daily_ema200],
+        stop_loss_price=entry * SL_MULT,
+        ema_relation=_EMA_RELATION[daily_ema100 > daily_ema200],
+        loss_pct=((price - entry) / entry) * 100,
     )
-    return table
 
 
 # ----------------- Telegram -----------------
 
-def should_send(state, symbol, text):
+def message_hash(text):
+    """Spam kontrolü için mesajın kısa (8 baytlık) özeti."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def should_send(state, symbol, msg_hash):
     """Basit spam kontrolü: aynı mesajı kısa sürede yeniden gönderme.
-    state içinde symbol->last_msg (metin) ve global_last_msg timestamp tutulur.
+    state içinde symbol->last_msg (mesaj hash'i) ve global_last_msg timestamp tutulur.
+    Aralık karşılaştırmaları saat ayarından etkilenmemesi için monotonic (mts) ile yapılır.
     """
-    now_ts = int(time.time())
+    now_mts = time.monotonic()
     symbol_last = state.get(symbol, {}).get("last_msg")
     global_last = state.get("global_last_msg")
 
     # Eğer tam olarak aynı mesaj son gönderilenle aynıysa  MIN_TELEGRAM_INTERVAL içinde engelle
     if symbol_last and isinstance(symbol_last, dict):
-        if symbol_last.get("text") == text and now_ts - symbol_last.get("ts", 0) < MIN_TELEGRAM_INTERVAL:
+        last_mts = symbol_last.get("mts")
+        if symbol_last.get("hash") == msg_hash and last_mts is not None and now_mts - last_mts < MIN_TELEGRAM_INTERVAL:
             return False
 
     if global_last and isinstance(global_last, dict):
-        if global_last.get("text") == text and now_ts - global_last.get("ts", 0) < 10:
+        last_mts = global_last.get("mts")
+        if global_last.get("hash") == msg_hash and last_mts is not None and now_mts - last_mts < 10:
             # global için daha kısa bekletme (aynı mesajın başka symbol'den gelmesi durumunda)
             return False
 
@@ -264,135 +476,280 @@ def should_send(state, symbol, text):
     return True
 
 
-def mark_sent(state, symbol, text):
-    now_ts = int(time.time())
+def mark_sent(state, symbol, msg_hash):
+    # ts: duvar saati (kayıt amaçlı), mts: aralık kontrolü için monotonic saat
+    sent = {"hash": msg_hash, "ts": int(time.time()), "mts": time.monotonic()}
     if symbol not in state:
         state[symbol] = {}
-    state[symbol]["last_msg"] = {"text": text, "ts": now_ts}
-    state["global_last_msg"] = {"text": text, "ts": now_ts}
-    save_state(state)
+    state[symbol]["last_msg"] = sent
+    state["global_last_msg"] = sent
+    mark_state_dirty()
 
 
 def send_telegram(msg: str, state=None, symbol=None):
+    """Telegram bildirimini gönderim kuyruğuna ekler; gönderim _tg_worker thread'inde yapılır."""
+    try:
+        TG_QUEUE.put_nowait((msg, state, symbol))
+    except queue.Full:
+        write_log("⚠️ Telegram kuyruğu dolu, mesaj atlandı.", level="WARNING", notify=False)
+
+
+def _do_send(msg: str, state=None, symbol=None):
     """Telegram’a bildirim gönderir (spam kontrolü entegre)."""
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
-        write_log("⚠️ Telegram ayarları eksik, mesaj gönderilemedi.")
+        write_log("⚠️ Telegram ayarları eksik, mesaj gönderilemedi.", level="WARNING", notify=False)
         return
 
     # Spam kontrolü aktif
     if state is not None and symbol is not None:
-        if not should_send(state, symbol, msg):
-            return
-        mark_sent(state, symbol, msg)
+        msg_hash = message_hash(msg)
+        with state_lock:
+            if not should_send(state, symbol, msg_hash):
+                return
+            mark_sent(state, symbol, msg_hash)
 
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     try:
-        r = requests.post(url, json={"chat_id": TELEGRAM_CHAT_ID, "text": msg})
+        r = TG_SESSION.post(url, json={"chat_id": TELEGRAM_CHAT_ID, "text": msg}, timeout=TELEGRAM_TIMEOUT)
         if r.status_code != 200:
-            write_log(f"Telegram gönderim hatası: {r.text}")
+            write_log(f"Telegram gönderim hatası: {r.text}", level="ERROR", notify=False)
     except Exception as e:
-        write_log(f"Telegram bağlantı hatası: {e}")
-
-
+        write_log(f"Telegram bağlantı hatası: {e}", level="ERROR", notify=False)
 
 
-# ----------------- Sinyal Kontrolü -----------------
+def _tg_worker():
+    """TG_QUEUE'daki mesajları sırayla gönderir; sinyal kontrolü Telegram gecikmesini beklemez."""
+    while True:
+        msg, state, symbol = TG_QUEUE.get()
+        try:
+            _do_send(msg, state=state, symbol=symbol)
+        except Exception as e:
+            write_log(f"Telegram gönderim hatası: {e}", level="ERROR", notify=False)
+        finally:
+            TG_QUEUE.task_done()
 
-def check_signals():
-    state = load_state()
 
-    for symbol in ASSETS:
-        try:
-            # 4H veriler
-            df_4h = safe_download(symbol, interval="4h", period="720d", retries=3)
-            if df_4h.empty or len(df_4h) < max(EMA_LONG, EMA_SHORT) + 2:
-                write_log(f"{symbol} için yeterli 4h veri yok veya indirme başarısız.", symbol=symbol)
-                continue
+def start_telegram_worker():
+    threading.Thread(target=_tg_worker, name="telegram", daemon=True).start()
 
-            df_4h["EMA_SHORT"] = get_ema(df_4h, EMA_SHORT)
-            df_4h["EMA_LONG"] = get_ema(df_4h, EMA_LONG)
 
-            last = df_4h.iloc[[-1]]
-            prev = df_4h.iloc[[-2]]
+def drain_telegram_queue(timeout=TG_DRAIN_TIMEOUT):
+    """Kapanışta kuyruktaki mesajların gönderilmesini en fazla timeout saniye bekler."""
+    waiter = threading.Thread(target=TG_QUEUE.join, daemon=True)
+    waiter.start()
+    waiter.join(timeout)
+    if waiter.is_alive():
+        write_log(f"⚠️ Kapanışta {TG_QUEUE.qsize()} Telegram mesajı gönderilemedi.", level="WARNING", notify=False)
 
-            price = last["Close"].iloc[0].item()
 
-            # Günlük veriler
-            df_1d = safe_download(symbol, interval="1d", period="600d", retries=3)
-            if df_1d.empty or len(df_1d) < 201:
-                write_log(f"{symbol} için yeterli 1d veri yok veya indirme başarısız.", symbol=symbol)
-                continue
+# ----------------- Sinyal Kontrolü -----------------
 
-            df_1d["EMA100"] = get_ema(df_1d, 100)
-            df_1d["EMA200"] = get_ema(df_1d, 200)
+def crossed_above(was_above, prev_short, last_short, prev_long, last_long):
+    """Kısa EMA'nın uzun EMA'nın üstüne geçip geçmediği.
+    was_above state'te saklanan son görülen yöndür; None ise son iki kapanmış mum karşılaştırılır.
+    """
+    if was_above is None:
+        was_above = not prev_short < prev_long
+    return last_short > last_long and not was_above
 
-            d_last = df_1d.iloc[[-1]]
-            daily_ema100 = d_last["EMA100"].iloc[0]
-            daily_ema200 = d_last["EMA200"].iloc[0]
 
-            # --- Alım Sinyali ---
-            if not state[symbol]["in_position"]:
-                # 4H EMA kesişimi yukarı
-                if prev["EMA_SHORT"].iloc[0] < prev["EMA_LONG"].iloc[0] and last["EMA_SHORT"].iloc[0] > last["EMA_LONG"].iloc[0]:
+def process_symbol(symbol, price, crossed_up, daily_ema100, daily_ema200, daily_crossed_up, state):
+    """Tek sembol için 4H alım sinyali ve günlük EMA ile TP yükseltme kontrolü.
+    state değişiklikleri state_lock altında yapılır.
+    """
+    try:
+        # --- Alım Sinyali ---
+        if not state[symbol]["in_position"]:
+            # 4H EMA kesişimi yukarı
+            if crossed_up:
+                with state_lock:
                     state[symbol]["in_position"] = True
                     state[symbol]["entry_price"] = price
                     state[symbol]["take_profit"] = TAKE_PROFIT
+                    mark_state_dirty()
+
+                table_msg = format_signal_log(symbol, price, daily_ema100, daily_ema200, entry_price=price, tp=TAKE_PROFIT)
+                send_telegram(table_msg, state=state, symbol=symbol)
+                write_log(f"ALIM sinyali: {symbol} | Price: {price:.2f}", symbol=symbol)
+
+        # --- Pozisyon Açıkken: Günlük EMA kesişimiyle TP'yi yükselt ---
+        elif daily_crossed_up:
+            if state[symbol].get("take_profit") != UPGRADED_TP:
+                with state_lock:
+                    state[symbol]["take_profit"] = UPGRADED_TP
+                    mark_state_dirty()
+                msg = (f"🔄 {symbol} için GÜNCELLEME!\nGünlük EMA100, EMA200'ü yukarı kesti.\nYeni Take-Profit hedefi: %{UPGRADED_TP}")
+                send_telegram(msg, state=state, symbol=symbol)
+                write_log(msg, symbol=symbol)
 
-                    table_msg = format_signal_log(symbol, price, daily_ema100, daily_ema200, entry_price=price, tp=TAKE_PROFIT)
-                    send_telegram(table_msg, state=state, symbol=symbol)
-                    write_log(f"ALIM sinyali: {symbol} | Price: {price:.2f}", symbol=symbol)
+    except Exception as e:
+        write_log(f"{symbol} için hata: {e}", symbol=symbol, level="ERROR")
 
-            # --- Pozisyon Açıkken ---
-            else:
-                entry = state[symbol]["entry_price"]
-                tp = state[symbol].get("take_profit", TAKE_PROFIT)
-
-                # Take Profit
-                if price >= entry * (1 + tp / 100):
-                    msg = f"✅ {symbol} kar al hedefi (%{tp}) gerçekleşti! Fiyat: {price:.2f} | Giriş: {entry:.2f}"
-                    send_telegram(msg, state=state, symbol=symbol)
-                    write_log(msg, symbol=symbol)
-                    state[symbol]["in_position"] = False
-                    state[symbol]["entry_price"] = None
-                    state[symbol]["take_profit"] = TAKE_PROFIT
 
-                # Stop Loss
-                elif price <= entry * (1 - STOP_LOSS / 100):
-                    table_msg = format_stoploss_log(symbol, price, entry, daily_ema100, daily_ema200)
-                    send_telegram(table_msg, state=state, symbol=symbol)
-                    write_log(f"STOP LOSS: {symbol} | Price: {price:.2f} | Entry: {entry:.2f}", symbol=symbol)
-                    state[symbol]["in_position"] = False
-                    state[symbol]["entry_price"] = None
-                    state[symbol]["take_profit"] = TAKE_PROFIT
+def check_crossovers(state):
+    """Kapanmış 4H mumlarda EMA kesişimlerini bulur ve aday semboller için günlük kontrolleri yapar.
+    Günlük verisi indirilemeyen alım kesişimlerini döner (bkz. process_candidates).
+    """
+    # Tüm semboller için tek seferde indir (sembol başına ayrı istek yerine); yalnızca Close dizileri tutulur
+    # 400 gün: kripto için ~2400, hisseler için ~550 adet 4H mum; EMA200 ısınması için yeterli
+    closes_4h = bulk_download(ASSETS, interval="4h", period="400d", closed_only=True)
+
+    # 4H EMA'lar tüm semboller için tek matris geçişinde hesaplanır
+    emas_4h = ema_pairs(closes_4h, ASSETS, EMA_SHORT, EMA_LONG, max(EMA_LONG, EMA_SHORT) + 2)
+
+    # Kesişim, state'te saklanan son görülen EMA yönüyle karşılaştırılarak bulunur; böylece iki kontrol
+    # arasında kaç mum kapanmış olursa olsun (veya bot yeniden başlasa da) yukarı geçiş kaçmaz.
+    # Günlük veri yalnızca 4H kesişimi olan veya pozisyonu açık semboller için gerekli
+    candidates = {}
+    ema_above = {}
+    for symbol in ASSETS:
+        if symbol not in emas_4h:
+            write_log(f"{symbol} için yeterli 4h veri yok veya indirme başarısız.", symbol=symbol)
+            continue
+        _, last_ema_short, _, last_ema_long = emas_4h[symbol]
+        crossed_up = crossed_above(state[symbol]["ema_above"], *emas_4h[symbol])
+        above = last_ema_short > last_ema_long
+        if crossed_up or state[symbol]["in_position"]:
+            candidates[symbol] = (float(closes_4h[symbol][-1]), crossed_up, above)
+        else:
+            ema_above[symbol] = above
+
+    set_directions(state, "ema_above", ema_above)
+    return process_candidates(state, candidates) if candidates else {}
+
+
+def process_candidates(state, candidates, retry=False):
+    """Aday semboller (symbol -> (4H fiyat, crossed_up, 4H yönü)) için günlük EMA'ları indirip işler.
+    Günlük verisi indirilemeyen alım kesişimlerini aynı biçimde döner; bunlar için
+    4H verisi yeniden indirilmeden yalnızca günlük veri tekrar denenir (retry=True).
+    """
+    closes_1d = cached_download(list(candidates), interval="1d", period="600d")
+    emas_1d = ema_pairs(closes_1d, list(candidates), 100, 200, 201)
+
+    pending = {}
+    ema_above = {}
+    daily_above = {}
+    for symbol, (_, crossed_up, above) in candidates.items():
+        if symbol in emas_1d:
+            ema_above[symbol] = above
+            continue
+        if crossed_up and not state[symbol]["in_position"] and len(closes_1d[symbol]) == 0:
+            # İndirme başarısız: 4H yönü kaydedilmez ki kesişim kaybolmasın; yalnızca ilk hata Telegram'a gider
+            pending[symbol] = candidates[symbol]
+            write_log(f"{symbol} için 1d indirme başarısız, tekrar denenecek.", symbol=symbol, notify=not retry)
+        else:
+            write_log(f"{symbol} için yeterli 1d veri yok veya indirme başarısız.", symbol=symbol)
+            ema_above[symbol] = above
+
+    # Günlük kesişim de 4H'deki gibi saklanan yönle karşılaştırılır: kapanmış mumlar kullanıldığından
+    # kesişim, günlük mum kapandıktan sonraki ilk kontrolde bulunur
+    # process_symbol ağ beklemez (send_telegram yalnızca kuyruğa ekler); düz döngü yeterli
+    for symbol, (_, daily_ema100, _, daily_ema200) in emas_1d.items():
+        # Stop-loss mesajları için son günlük EMA değerlerini sakla
+        _daily_emas[symbol] = (daily_ema100, daily_ema200)
+        daily_crossed_up = crossed_above(state[symbol]["daily_above"], *emas_1d[symbol])
+        daily_above[symbol] = daily_ema100 > daily_ema200
+        price, crossed_up, _ = candidates[symbol]
+        process_symbol(symbol, price, crossed_up, daily_ema100, daily_ema200, daily_crossed_up, state)
+
+    set_directions(state, "ema_above", ema_above)
+    set_directions(state, "daily_above", daily_above)
+    return pending
+
+
+def set_directions(state, key, directions):
+    """Son görülen EMA yönlerini (symbol -> bool) state[symbol][key] alanına yazar."""
+    with state_lock:
+        for symbol, above in directions.items():
+            if state[symbol][key] != above:
+                state[symbol][key] = above
+                mark_state_dirty()
+
+
+def fetch_latest_prices(symbols):
+    """Semboller için son dakikalık kapanış fiyatlarını döner (symbol -> price)."""
+    closes = bulk_download(symbols, interval="1m", period="1d")
+    return {symbol: float(close[-1]) for symbol, close in closes.items() if len(close)}
+
+
+def check_stops(state, latest_prices):
+    """Açık pozisyonlar için take-profit / stop-loss kontrolü; her STOP_CHECK_INTERVAL saniyede çalıştırılır."""
+    for symbol, price in latest_prices.items():
+        try:
+            if not state[symbol]["in_position"]:
+                continue
+            entry = state[symbol]["entry_price"]
+            tp = state[symbol].get("take_profit", TAKE_PROFIT)
+
+            # Take Profit
+            if price >= entry * (1 + tp / 100):
+                msg = f"✅ {symbol} kar al hedefi (%{tp}) gerçekleşti! Fiyat: {price:.2f} | Giriş: {entry:.2f}"
+                send_telegram(msg, state=state, symbol=symbol)
+                write_log(msg, symbol=symbol)
+
+            # Stop Loss
+            elif price <= entry * SL_MULT:
+                daily_ema100, daily_ema200 = _daily_emas.get(symbol, (math.nan, math.nan))
+                table_msg = format_stoploss_log(symbol, price, entry, daily_ema100, daily_ema200)
+                send_telegram(table_msg, state=state, symbol=symbol)
+                write_log(f"STOP LOSS: {symbol} | Price: {price:.2f} | Entry: {entry:.2f}", symbol=symbol)
 
-                else:
-                    # Günlük EMA kesişimiyle TP'yi yükselt
-                    prev_ema100 = df_1d["EMA100"].iloc[-2]
-                    prev_ema200 = df_1d["EMA200"].iloc[-2]
-                    curr_ema100 = daily_ema100
-                    curr_ema200 = daily_ema200
+            else:
+                continue
 
-                    if prev_ema100 < prev_ema200 and curr_ema100 > curr_ema200:
-                        if state[symbol].get("take_profit") != UPGRADED_TP:
-                            state[symbol]["take_profit"] = UPGRADED_TP
-                            msg = (f"🔄 {symbol} için GÜNCELLEME!\nGünlük EMA100, EMA200'ü yukarı kesti.\nYeni Take-Profit hedefi: %{UPGRADED_TP}")
-                            send_telegram(msg, state=state, symbol=symbol)
-                            write_log(msg, symbol=symbol)
+            with state_lock:
+                state[symbol]["in_position"] = False
+                state[symbol]["entry_price"] = None
+                state[symbol]["take_profit"] = TAKE_PROFIT
+                mark_state_dirty()
 
         except Exception as e:
             write_log(f"{symbol} için hata: {e}", symbol=symbol, level="ERROR")
 
-    save_state(state)
-
 
 # ----------------- Ana Döngü -----------------
 if __name__ == "__main__":
+    start_telegram_worker()
     write_log("🚀 Bot başlatıldı")
     send_telegram("🚀 Bot başlatıldı")
+    # State yalnızca açılışta okunur, sonrasında bellekte tutulur
+    state = load_state()
     # ilk state kaydetme (varsayılanları oluşturmak için)
-    s = load_state()
-    save_state(s)
+    save_state(state)
+
+    # Kapanışta (SIGTERM dahil) bekleyen state değişikliklerini yaz
+    def _flush_state_at_exit():
+        with state_lock:
+            maybe_flush_state(state, min_interval=0)
+
+    atexit.register(_flush_state_at_exit)
+    # atexit ters sırada çalışır: önce Telegram kuyruğu boşaltılır (mark_sent state'i değiştirir), sonra state yazılır
+    atexit.register(drain_telegram_queue)
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
 
+    next_crossover_check = 0
+    pending = {}  # günlük verisi indirilemeyen alım kesişimleri; her turda yalnızca 1d tekrar denenir
     while True:
-        check_signals()
-        time.sleep(60)  # her dakika kontrol
+        # Kesişimler yalnızca kapanmış 4H mumlarda aranır; CROSSOVER_CHECK_INTERVAL'de bir kontrol yeterli.
+        # Hata olursa da bir sonraki kontrole kadar beklenir: yönler state'te olduğundan kesişim kaçmaz
+        try:
+            if time.time() >= next_crossover_check:
+                next_crossover_check = time.time() + CROSSOVER_CHECK_INTERVAL
+                pending = check_crossovers(state)
+            elif pending:
+                pending = process_candidates(state, pending, retry=True)
+        except Exception as e:
+            write_log(f"Kesişim kontrolü hatası: {e}", level="ERROR")
+
+        # TP/SL için yalnızca açık pozisyonların son fiyatı çekilir
+        try:
+            open_positions = [symbol for symbol in ASSETS if state[symbol]["in_position"]]
+            if open_positions:
+                check_stops(state, fetch_latest_prices(open_positions))
+        except Exception as e:
+            write_log(f"TP/SL kontrolü hatası: {e}", level="ERROR")
+
+        with state_lock:
+            maybe_flush_state(state)
+
+        time.sleep(STOP_CHECK_INTERVAL)